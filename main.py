@@ -2,124 +2,405 @@
 
 import argparse
 import asyncio
+import io
 import os
 import shutil
-from typing import Iterable
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator
 
-import aiohttp
+import httpx
+import numpy as np
 from PIL import Image
 from tqdm import tqdm
-from tqdm.asyncio import tqdm_asyncio
 
+TILES_URL = "https://static.xam.nu/dayz/maps/chernarusplus"
 MAX_CONCURRENT = 64
-TIMEOUT = aiohttp.ClientTimeout(total=30)
+CHUNK_SIZE = 1 << 16
+MAX_ATLAS_SIZE = 16383
+MANIFEST_NAME = "done.bin"
+DZI_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="webp" Overlap="0" TileSize="256">
+    <Size Width="{width}" Height="{height}"/>
+</Image>
+"""
+REQUEST_TIMEOUT = 30
+# httpx applies this to each connect/read/write/pool wait separately;
+# the whole request is capped with asyncio.timeout in download_tile.
+TIMEOUT = httpx.Timeout(REQUEST_TIMEOUT)
+# disable=None turns the bars off when stderr is not a terminal
+PROGRESS_OPTIONS = dict(unit="tile", mininterval=0.2, smoothing=0, leave=False, disable=None)
 
 
 async def download_tile(
-        sem: asyncio.Semaphore,
-        target_dir: str,
-        session: aiohttp.ClientSession,
-        game_version: str,
-        map_type: str,
-        resolution: int,
+        client: httpx.AsyncClient,
+        url_base: str,
+        dir_base: str,
         x: int,
         y: int,
+        keep: bool = False,
+) -> bytes | None:
+    tile_suffix = f"/{x}/{y}.webp"
+    url = url_base + tile_suffix
+    out_path = dir_base + tile_suffix
+
+    async with asyncio.timeout(REQUEST_TIMEOUT), client.stream("GET", url) as r:
+        r.raise_for_status()
+
+        content_type = r.headers.get("content-type", "").partition(";")[0]
+        if content_type != "image/webp":
+            raise RuntimeError(
+                f"{x}/{y}: invalid content-type {content_type}"
+            )
+
+        chunks = [] if keep else None
+        part_path = f"{out_path}.part"
+        with open(part_path, "wb") as f:
+            async for chunk in r.aiter_bytes(CHUNK_SIZE):
+                if chunks is not None:
+                    chunks.append(chunk)
+                await asyncio.to_thread(f.write, chunk)
+        os.replace(part_path, out_path)
+
+    if chunks is None:
+        return None
+
+    return b"".join(chunks)
+
+
+async def download_worker(
+        coords: Iterator[tuple[int, int]],
+        pbar: tqdm,
+        client: httpx.AsyncClient,
+        url_base: str,
+        dir_base: str,
+        tile_data: dict[tuple[int, int], bytes] | None,
+        done: np.ndarray,
+        grid_size: int,
 ):
-    out_dir = f"{target_dir}/{game_version}_{map_type}_{resolution}x{resolution}"
-    os.makedirs(out_dir, exist_ok=True)
+    for x, y in coords:
+        data = await download_tile(client, url_base, dir_base, x, y, keep=tile_data is not None)
+        if tile_data is not None:
+            tile_data[x, y] = data
+
+        i = x * grid_size + y
+        done[i >> 3] |= 1 << (i & 7)
+        pbar.update(1)
+
+
+def scan_existing_tiles(out_dir: str, grid_size: int) -> set[tuple[int, int]]:
+    existing = set()
+
+    for x in range(grid_size):
+        with os.scandir(os.path.join(out_dir, str(x))) as it:
+            for entry in it:
+                if entry.name.endswith(".webp"):
+                    existing.add((x, int(entry.name[:-5])))
+
+    return existing
+
+
+def open_manifest(out_dir: str, grid_size: int) -> tuple[np.memmap, bool]:
+    """Return the manifest and whether it was just seeded from disk."""
+    manifest_path = os.path.join(out_dir, MANIFEST_NAME)
+    shape = ((grid_size * grid_size + 7) // 8,)
+
+    if os.path.exists(manifest_path):
+        return np.memmap(manifest_path, dtype=np.uint8, mode="r+", shape=shape), False
+
+    # No manifest yet (fresh run or a tmp dir from an older version):
+    # seed it from whatever tiles are already on disk.
+    done = np.memmap(manifest_path, dtype=np.uint8, mode="w+", shape=shape)
+    for x, y in scan_existing_tiles(out_dir, grid_size):
+        i = x * grid_size + y
+        done[i >> 3] |= 1 << (i & 7)
+    done.flush()
+
+    return done, True
+
+
+def find_lost_tiles(out_dir: str, grid_size: int, claimed: np.ndarray) -> list[int]:
+    existing = scan_existing_tiles(out_dir, grid_size)
+    return [i for i in claimed.tolist() if divmod(i, grid_size) not in existing]
+
+
+def fits_atlas(grid_size: int) -> bool:
+    return grid_size * 256 <= MAX_ATLAS_SIZE
+
+
+def decode_tile(tile_source: str | bytes) -> np.ndarray:
+    if isinstance(tile_source, bytes):
+        tile_source = io.BytesIO(tile_source)
+
+    with Image.open(tile_source) as tile:
+        return np.asarray(tile.convert("RGB"))
 
-    async with sem:
-        x_dir = os.path.join(out_dir, str(x))
-        os.makedirs(x_dir, exist_ok=True)
 
-        out_path = os.path.join(x_dir, f"{y}.webp")
-        if os.path.exists(out_path):
-            return
+def check_pyvips():
+    try:
+        import pyvips  # noqa: F401
+    except (ImportError, OSError):
+        raise SystemExit(
+            "❌ Для карт больше 16383x16383 нужен libvips (pyvips не загружается)"
+        )
+
+
+def save_pyramid(tiles_dir: str, pyramid_path: str, grid_size: int, image_format: str):
+    # Imported here so small maps don't need libvips loaded at all;
+    # main() has already checked that it is available when needed.
+    import pyvips
 
-        url = (
-            f"https://static.xam.nu/dayz/maps/"
-            f"chernarusplus/{game_version}/{map_type}/{resolution}/{x}/{y}.webp"
+    tiles = [
+        pyvips.Image.new_from_file(
+            os.path.join(tiles_dir, str(x), f"{y}.webp"),
+            access="sequential",
         )
+        for y in range(grid_size)
+        for x in range(grid_size)
+    ]
 
-        async with session.get(url) as r:
-            r.raise_for_status()
+    joined = pyvips.Image.arrayjoin(tiles, across=grid_size)
+    joined.dzsave(pyramid_path, suffix=f".{image_format.lower()}")
 
-            if r.content_type != "image/webp":
-                raise RuntimeError(
-                    f"{x}/{y}: invalid content-type {r.content_type}"
-                )
 
-            data = await r.read()
-            with open(out_path, "wb") as f:
-                f.write(data)
+def downsample_tile(src_dir: str, dst_dir: str, src_side: int, x: int, y: int):
+    if src_side == 1:
+        with Image.open(os.path.join(src_dir, "0_0.webp")) as child:
+            parent = child.convert("RGB")
+    else:
+        parent = Image.new("RGB", (512, 512))
+        for dx in (0, 1):
+            for dy in (0, 1):
+                with Image.open(os.path.join(src_dir, f"{2 * x + dx}_{2 * y + dy}.webp")) as child:
+                    parent.paste(child.convert("RGB"), (dx * 256, dy * 256))
+
+    parent.reduce(2).save(os.path.join(dst_dir, f"{x}_{y}.webp"), format="WEBP")
 
 
-async def glue_tiles(
+def save_deepzoom(
         tiles_dir: str,
         out_dir: str,
         game_version: str,
         map_type: str,
         resolution: int,
-        image_format: str
+):
+    grid_size = 2 ** resolution
+    name = f"{map_type}_{game_version}_{grid_size}x{grid_size}"
+    files_dir = os.path.join(out_dir, f"{name}_files")
+
+    # xam.nu resolution N is a 2^N x 2^N grid of 256px tiles, which is
+    # exactly DeepZoom level N + 8, so the top level only needs moving.
+    top_level = resolution + 8
+    level_dir = os.path.join(files_dir, str(top_level))
+    os.makedirs(level_dir, exist_ok=True)
+
+    # The tiles are about to leave the tmp dir, so the manifest must stop
+    # vouching for them; otherwise an interrupted run could never resume.
+    try:
+        os.remove(os.path.join(tiles_dir, MANIFEST_NAME))
+    except FileNotFoundError:
+        pass
+
+    for x in range(grid_size):
+        for y in range(grid_size):
+            shutil.move(
+                os.path.join(tiles_dir, str(x), f"{y}.webp"),
+                os.path.join(level_dir, f"{x}_{y}.webp"),
+            )
+
+    # Viewers request every level down to 0 when zoomed out; build them
+    # by halving the level above (a quarter as many tiles each time).
+    sides = {level: 2 ** max(level - 8, 0) for level in range(top_level + 1)}
+    total_tiles = sum(sides[level] ** 2 for level in range(top_level))
+
+    with (
+        tqdm(total=total_tiles, desc=f"DeepZoom {game_version}/{map_type}/{resolution}", **PROGRESS_OPTIONS) as pbar,
+        ThreadPoolExecutor(max_workers=os.cpu_count()) as executor,
+    ):
+        for level in range(top_level - 1, -1, -1):
+            src_dir = os.path.join(files_dir, str(level + 1))
+            dst_dir = os.path.join(files_dir, str(level))
+            os.makedirs(dst_dir, exist_ok=True)
+
+            side = sides[level]
+            coords = [(x, y) for x in range(side) for y in range(side)]
+            for _ in executor.map(
+                    lambda xy: downsample_tile(src_dir, dst_dir, sides[level + 1], *xy),
+                    coords,
+            ):
+                pbar.update(1)
+
+    size = grid_size * 256
+    dzi_path = os.path.join(out_dir, f"{name}.dzi")
+    with open(dzi_path, "w", encoding="utf-8") as f:
+        f.write(DZI_TEMPLATE.format(width=size, height=size))
+
+    return dzi_path
+
+
+def glue_tiles(
+        tiles_dir: str,
+        out_dir: str,
+        game_version: str,
+        map_type: str,
+        resolution: int,
+        image_format: str,
+        tile_data: dict[tuple[int, int], bytes] | None = None,
+        deepzoom: bool = False,
 ):
     os.makedirs(out_dir, exist_ok=True)
 
+    if deepzoom:
+        dzi_path = save_deepzoom(tiles_dir, out_dir, game_version, map_type, resolution)
+        print(f"Saved map tiles: {dzi_path}")
+        return
+
     grid_size = 2 ** resolution
 
-    atlas_path = os.path.join(out_dir, f"{map_type}_{game_version}_{grid_size}x{grid_size}.{image_format.lower()}")
+    atlas_name = f"{map_type}_{game_version}_{grid_size}x{grid_size}"
 
     canvas_width = grid_size * 256
     canvas_height = grid_size * 256
 
-    atlas = Image.new("RGBA", (canvas_width, canvas_height))
+    if not fits_atlas(grid_size):
+        pyramid_path = os.path.join(out_dir, atlas_name)
+        save_pyramid(tiles_dir, pyramid_path, grid_size, image_format)
+        print(f"Saved map pyramid: {pyramid_path}")
+        return
+
+    atlas_path = os.path.join(out_dir, f"{atlas_name}.{image_format.lower()}")
+
+    canvas = np.empty((canvas_height, canvas_width, 3), dtype=np.uint8)
 
     total_tiles = grid_size * grid_size
-    with tqdm(total=total_tiles, desc=f"Glue {game_version}/{map_type}/{resolution}", unit="tile") as pbar:
-        for x in range(grid_size):
-            for y in range(grid_size):
-                tile_path = os.path.join(tiles_dir, str(x), f"{y}.webp")
-                tile = Image.open(tile_path).convert("RGBA")
-                atlas.paste(tile, (x * 256, y * 256), tile)
-                pbar.update(1)
+    coords = [(x, y) for x in range(grid_size) for y in range(grid_size)]
+    tile_data = tile_data or {}
+    tile_sources = (
+        tile_data.get((x, y)) or os.path.join(tiles_dir, str(x), f"{y}.webp")
+        for x, y in coords
+    )
+
+    with (
+        tqdm(total=total_tiles, desc=f"Glue {game_version}/{map_type}/{resolution}", **PROGRESS_OPTIONS) as pbar,
+        ThreadPoolExecutor(max_workers=os.cpu_count()) as executor,
+    ):
+        for (x, y), tile in zip(coords, executor.map(decode_tile, tile_sources)):
+            canvas[y * 256:(y + 1) * 256, x * 256:(x + 1) * 256] = tile
+            pbar.update(1)
 
+    atlas = Image.fromarray(canvas)
     atlas.save(atlas_path, format=image_format)
     print(f"Saved map: {atlas_path}")
 
 
-async def download_all_tiles(
+async def glue_and_remove_tiles(
+        tiles_dir: str,
+        out_dir: str,
         game_version: str,
         map_type: str,
         resolution: int,
-        target_dir: str
+        image_format: str,
+        tile_data: dict[tuple[int, int], bytes] | None = None,
+        deepzoom: bool = False,
+        cleanup_tasks: list[asyncio.Task] | None = None,
 ):
+    await asyncio.to_thread(
+        glue_tiles, tiles_dir, out_dir, game_version, map_type, resolution, image_format, tile_data, deepzoom
+    )
+
+    # Renaming is instant, so the tiles are out of the way right away and
+    # the slow per-file delete runs in the background.
+    gone_dir = f"{tiles_dir}.gone.{os.getpid()}"
+    os.rename(tiles_dir, gone_dir)
+
+    remove_task = asyncio.create_task(asyncio.to_thread(shutil.rmtree, gone_dir))
+    if cleanup_tasks is None:
+        await remove_task
+    else:
+        cleanup_tasks.append(remove_task)
+
+
+async def download_all_tiles(
+        client: httpx.AsyncClient,
+        game_version: str,
+        map_type: str,
+        resolution: int,
+        target_dir: str,
+        concurrency: int = MAX_CONCURRENT,
+        keep_tile_data: bool = False,
+) -> dict[tuple[int, int], bytes] | None:
     grid_size = 2 ** resolution
-    sem = asyncio.Semaphore(MAX_CONCURRENT)
 
-    async with aiohttp.ClientSession(
-            timeout=TIMEOUT,
-    ) as session:
-        tasks = [
-            asyncio.create_task(
-                download_tile(
-                    sem, target_dir, session,
-                    game_version, map_type, resolution,
-                    x, y
-                ),
-                name=f"download_tile_{game_version}_{map_type}_{resolution}_{x}_{y}",
-            )
-            for x in range(grid_size)
-            for y in range(grid_size)
-        ]
+    out_dir = f"{target_dir}/{game_version}_{map_type}_{resolution}x{resolution}"
+    os.makedirs(out_dir, exist_ok=True)
+    await asyncio.gather(*(
+        asyncio.to_thread(os.makedirs, os.path.join(out_dir, str(x)), exist_ok=True)
+        for x in range(grid_size)
+    ))
+
+    done, seeded = await asyncio.to_thread(open_manifest, out_dir, grid_size)
+    have = np.unpackbits(done, count=grid_size * grid_size, bitorder="little")
+    missing = np.flatnonzero(have == 0)
+
+    # A reused manifest may claim tiles that are gone (deleted by hand to
+    # force a refetch, say). Check it against the disk in the background
+    # while the missing tiles download, then fetch whatever was lost.
+    lost_check = None
+    if not seeded:
+        lost_check = asyncio.create_task(
+            asyncio.to_thread(find_lost_tiles, out_dir, grid_size, np.flatnonzero(have))
+        )
+
+    url_base = f"{TILES_URL}/{game_version}/{map_type}/{resolution}"
+
+    tile_data = {} if keep_tile_data else None
+
+    with tqdm(
+            total=grid_size * grid_size,
+            initial=grid_size * grid_size - len(missing),
+            desc=f"Download {game_version}/{map_type}/{resolution}",
+            **PROGRESS_OPTIONS,
+    ) as pbar:
+        async def download(indices: list[int]):
+            coords = (divmod(i, grid_size) for i in indices)
+            workers = [
+                asyncio.create_task(
+                    download_worker(coords, pbar, client, url_base, out_dir, tile_data, done, grid_size)
+                )
+                for _ in range(concurrency)
+            ]
+
+            try:
+                await asyncio.gather(*workers)
+            except:
+                for w in workers:
+                    w.cancel()
+                raise
 
         try:
-            await tqdm_asyncio.gather(
-                *tasks,
-                desc=f"Download {game_version}/{map_type}/{resolution}",
-            )
+            await download(missing.tolist())
+
+            lost = await lost_check if lost_check is not None else []
+            if lost:
+                for i in lost:
+                    done[i >> 3] &= 0xFF ^ (1 << (i & 7))
+                pbar.update(-len(lost))
+                await download(lost)
         except:
-            for t in tasks:
-                t.cancel()
+            if lost_check is not None:
+                lost_check.cancel()
             raise
+        finally:
+            done.flush()
+
+    return tile_data
+
+
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
 
 
 def parse_args():
@@ -154,6 +435,13 @@ def parse_args():
         help="Resolution range, e.g. 5 8",
     )
 
+    parser.add_argument(
+        "--concurrency",
+        type=positive_int,
+        default=MAX_CONCURRENT,
+        help="Max simultaneous tile downloads",
+    )
+
     parser.add_argument(
         "--tmp-dir",
         type=str,
@@ -176,6 +464,13 @@ def parse_args():
         help="Dir to store downloaded glued tiles",
     )
 
+    parser.add_argument(
+        "--deepzoom",
+        action="store_true",
+        help="Don't glue: store tiles as a DeepZoom (.dzi) pyramid in WEBP, "
+             "one per resolution; lower zoom levels are built by downscaling",
+    )
+
     return parser.parse_args()
 
 
@@ -195,23 +490,70 @@ async def main():
     else:
         resolutions = [args.resolution]
 
-    for res in resolutions:
-        await download_all_tiles(
-            game_version=args.version,
-            map_type=args.map_type,
-            resolution=res,
-            target_dir=args.tmp_dir
-        )
+    if not args.deepzoom and not all(fits_atlas(2 ** res) for res in resolutions):
+        check_pyvips()
+
+    limits = httpx.Limits(
+        max_connections=args.concurrency,
+        max_keepalive_connections=args.concurrency,
+    )
+
+    async with httpx.AsyncClient(
+            http2=True,
+            timeout=TIMEOUT,
+            limits=limits,
+    ) as client:
+        glue_task: asyncio.Task | None = None
+        cleanup_tasks: list[asyncio.Task] = []
+
+        for res in resolutions:
+            tile_data = await download_all_tiles(
+                client=client,
+                game_version=args.version,
+                map_type=args.map_type,
+                resolution=res,
+                target_dir=args.tmp_dir,
+                concurrency=args.concurrency,
+                # Small maps are glued in memory, so keep the fresh tiles
+                # around instead of reading them back from disk.
+                keep_tile_data=not args.deepzoom and fits_atlas(2 ** res),
+            )
+
+            current_map_tiles_dir = os.path.join(
+                args.tmp_dir,
+                f'{args.version}_{args.map_type}_{res}x{res}'
+            )
+
+            if glue_task is not None:
+                await glue_task
+
+            glue_task = asyncio.create_task(
+                glue_and_remove_tiles(
+                    current_map_tiles_dir, args.out_dir, args.version, args.map_type, res, args.out_format, tile_data,
+                    args.deepzoom, cleanup_tasks,
+                )
+            )
+
+        if glue_task is not None:
+            await glue_task
+
+        await asyncio.gather(*cleanup_tasks)
+
+    shutil.rmtree(args.tmp_dir)
 
-        current_map_tiles_dir = os.path.join(
-            args.tmp_dir,
-            f'{args.version}_{args.map_type}_{res}x{res}'
-        )
 
-        await glue_tiles(current_map_tiles_dir, args.out_dir, args.version, args.map_type, res, args.out_format)
+def install_event_loop():
+    try:
+        if sys.platform == "win32":
+            import winloop as uvloop
+        else:
+            import uvloop
+    except ImportError:
+        return
 
-        shutil.rmtree(args.tmp_dir)
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
 
 if __name__ == "__main__":
+    install_event_loop()
     asyncio.run(main())